@@ -34,7 +34,7 @@ def run(command, env=None, cwd=None, display=None):
 
     res = subprocess.run(
         command.split(" "),
-        env=dict(**os.environ, **env),
+        env={**os.environ, **env} if env else None,
         cwd=cwd,
     )
 
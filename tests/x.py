@@ -5,14 +5,36 @@ import os
 import sys
 import time
 import argparse
-from glob import glob
-from docker import start_database
+import atexit
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from docker import DatabaseError, cancel_waits, start_database, start_services, stop_services
+
+def jobs_count(value):
+    jobs = int(value)
+
+    if jobs < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {jobs}")
+
+    return jobs
+
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-t", "--target")
 parser.add_argument("-e", "--target-exact")
 parser.add_argument("-l", "--list-targets", action="store_true")
 parser.add_argument("--test")
+parser.add_argument("--incremental", action="store_true", help="keep incremental compilation enabled")
+parser.add_argument("--stop", action="store_true", help="stop the database services once done")
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=jobs_count,
+    default=max(1, (os.cpu_count() or 1) // 2),
+    help="number of tasks to run at once; output is buffered per task unless only one runs at a time",
+)
 
 argv, unknown = parser.parse_known_args()
 
@@ -22,10 +44,27 @@ dir_workspace = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 # dir of tests
 dir_tests = os.path.join(dir_workspace, "tests")
 
+# only one task at a time may write its output
+output_lock = threading.Lock()
+
+# tags already printed by `--list-targets`
+listed_targets = set()
+
+# (service, command) pairs selected from the matrix, executed once it is fully enumerated
+tasks = []
+
+# tags of the tasks that failed, in the order they finished
+failed_tags = []
+
+# set on Ctrl-C, so the workers stop taking queued tasks
+stopping = threading.Event()
+
 
 def run(command, comment=None, env=None, service=None, tag=None, args=None, database_url_args=None):
     if argv.list_targets:
-        if tag:
+        # tags do not include the tls backend, so most appear once per backend
+        if tag and tag not in listed_targets:
+            listed_targets.add(tag)
             print(f"{tag}")
 
         return
@@ -36,13 +75,30 @@ def run(command, comment=None, env=None, service=None, tag=None, args=None, data
     if argv.target_exact and tag != argv.target_exact:
         return
 
+    tasks.append((service, partial(
+        execute, command, comment=comment, env=env, service=service, tag=tag, args=args,
+        database_url_args=database_url_args)))
+
+
+def execute(command, comment=None, env=None, service=None, tag=None, args=None, database_url_args=None):
+    # lines printed ahead of the command output
+    header = []
+
     if comment is not None:
-        print(f"\x1b[2m # {comment}\x1b[0m")
+        header.append(f"\x1b[2m # {comment}\x1b[0m")
 
     environ = env or {}
 
     if service is not None:
-        database_url = start_database(service, database="sqlite/sqlite.db" if service == "sqlite" else "sqlx", cwd=dir_tests)
+        try:
+            database_url = start_database(service, database="sqlite/sqlite.db" if service == "sqlite" else "sqlx", cwd=dir_tests)
+
+        except DatabaseError as error:
+            with output_lock:
+                print("\n".join(header), flush=True)
+                print(f"\x1b[91m ! {error}\x1b[0m", file=sys.stderr, flush=True)
+
+            return 1
 
         if database_url_args:
             database_url += "?" + database_url_args
@@ -50,7 +106,7 @@ def run(command, comment=None, env=None, service=None, tag=None, args=None, data
         environ["DATABASE_URL"] = database_url
 
         # show the database url
-        print(f"\x1b[94m @ {database_url}\x1b[0m")
+        header.append(f"\x1b[94m @ {database_url}\x1b[0m")
 
     command_args = []
 
@@ -63,35 +119,92 @@ def run(command, comment=None, env=None, service=None, tag=None, args=None, data
         if args is not None:
             command_args.extend(args)
 
-    print(f"\x1b[93m $ {command} {' '.join(command_args)}\x1b[0m")
+    cmd = [*command, *command_args]
+
+    header.append(f"\x1b[93m $ {' '.join(cmd)}\x1b[0m")
 
     cwd = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-    res = subprocess.run(
-        [
-            *command.split(" "),
-            *command_args
-        ],
-        env=dict(**os.environ, **environ),
-        cwd=cwd,
-    )
 
-    if res.returncode != 0:
-        sys.exit(res.returncode)
+    if streaming:
+        print("\n".join(header), flush=True)
+
+        return subprocess.run(cmd, env={**os.environ, **environ} if environ else None, cwd=cwd).returncode
+
+    # cargo only colours its output when writing to a terminal, which it no longer is once piped
+    if sys.stdout.isatty() and "CARGO_TERM_COLOR" not in os.environ:
+        environ["CARGO_TERM_COLOR"] = "always"
+
+    env = {**os.environ, **environ} if environ else None
+
+    # the output only shows once the task is done, so show that it started
+    with output_lock:
+        print(f"\x1b[2m started {tag}\x1b[0m", flush=True)
+
+    # buffer the output so tasks running in parallel do not interleave
+    res = subprocess.run(cmd, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    with output_lock:
+        print("\n".join(header), flush=True)
+        sys.stdout.buffer.write(res.stdout)
+        sys.stdout.buffer.flush()
+
+    return res.returncode
+
+
+# run tasks in order, stopping at the first failure
+def execute_all(chain):
+    for task in chain:
+        if stopping.is_set():
+            return 130
+
+        returncode = task()
+
+        if returncode != 0:
+            failed_tags.append(task.keywords["tag"])
+            return returncode
+
+    return 0
+
+
+# remove profile data (`*.gc*`) under `root`, unlinking as the tree is walked
+def remove_profile_data(root):
+    try:
+        entries = os.scandir(root)
+
+    except FileNotFoundError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                remove_profile_data(entry.path)
+
+            elif ".gc" in entry.name:
+                try:
+                    os.unlink(entry.path)
+
+                except FileNotFoundError:
+                    pass
 
 
 # before we start, we clean previous profile data
 # keeping these around can cause weird errors
-for path in glob(os.path.join(os.path.dirname(__file__), "target/**/*.gc*"), recursive=True):
-    os.remove(path)
+remove_profile_data(os.path.join(os.path.dirname(__file__), "target"))
+
+runtimes = ["async-std", "tokio", "actix"]
+tls_backends = ["native-tls", "rustls"]
+
+# postgres ssl verified against the test ca
+postgres_ssl_args = "sslmode=verify-ca&sslrootcert=.%2Ftests%2Fcerts%2Fca.crt"
 
 #
 # check
 #
 
-for runtime in ["async-std", "tokio", "actix"]:
-    for tls in ["native-tls", "rustls"]:
+for runtime in runtimes:
+    for tls in tls_backends:
         run(
-            f"cargo c --no-default-features --features all-databases,all-types,offline,macros,runtime-{runtime}-{tls}",
+            ["cargo", "c", "--no-default-features", "--features", f"all-databases,all-types,offline,macros,runtime-{runtime}-{tls}"],
             comment="check with async-std",
             tag=f"check_{runtime}_{tls}"
         )
@@ -100,10 +213,10 @@ for runtime in ["async-std", "tokio", "actix"]:
 # unit test
 #
 
-for runtime in ["async-std", "tokio", "actix"]:
-    for tls in ["native-tls", "rustls"]:
+for runtime in runtimes:
+    for tls in tls_backends:
         run(
-            f"cargo test --no-default-features --manifest-path sqlx-core/Cargo.toml --features all-databases,all-types,runtime-{runtime}-{tls}",
+            ["cargo", "test", "--no-default-features", "--manifest-path", "sqlx-core/Cargo.toml", "--features", f"all-databases,all-types,runtime-{runtime}-{tls}"],
             comment="unit test core",
             tag=f"unit_{runtime}_{tls}"
         )
@@ -112,18 +225,27 @@ for runtime in ["async-std", "tokio", "actix"]:
 # integration tests
 #
 
-for runtime in ["async-std", "tokio", "actix"]:
-    for tls in ["native-tls", "rustls"]:
+for runtime in runtimes:
+    for tls in tls_backends:
+        # `cargo test` command for each driver, shared by all of its versions
+        commands = {
+            driver: ["cargo", "test", "--no-default-features", "--features",
+                     f"macros,offline,any,all-types,{driver},runtime-{runtime}-{tls}"]
+            for driver in ["sqlite", "postgres", "mysql", "mssql"]
+        }
+
+        # tags of the default runtime carry no suffix
+        suffix = "" if runtime == "async-std" else f"_{runtime}"
 
         #
         # sqlite
         #
 
         run(
-            f"cargo test --no-default-features --features macros,offline,any,all-types,sqlite,runtime-{runtime}-{tls}",
+            commands["sqlite"],
             comment=f"test sqlite",
             service="sqlite",
-            tag=f"sqlite" if runtime == "async-std" else f"sqlite_{runtime}",
+            tag=f"sqlite{suffix}",
         )
 
         #
@@ -132,20 +254,20 @@ for runtime in ["async-std", "tokio", "actix"]:
 
         for version in ["13", "12", "11", "10", "9_6"]:
             run(
-                f"cargo test --no-default-features --features macros,offline,any,all-types,postgres,runtime-{runtime}-{tls}",
+                commands["postgres"],
                 comment=f"test postgres {version}",
                 service=f"postgres_{version}",
-                tag=f"postgres_{version}" if runtime == "async-std" else f"postgres_{version}_{runtime}",
+                tag=f"postgres_{version}{suffix}",
             )
 
         ## +ssl
         for version in ["13", "12", "11", "10", "9_6"]:
             run(
-                f"cargo test --no-default-features --features macros,offline,any,all-types,postgres,runtime-{runtime}-{tls}",
+                commands["postgres"],
                 comment=f"test postgres {version} ssl",
-                database_url_args="sslmode=verify-ca&sslrootcert=.%2Ftests%2Fcerts%2Fca.crt",
+                database_url_args=postgres_ssl_args,
                 service=f"postgres_{version}",
-                tag=f"postgres_{version}_ssl" if runtime == "async-std" else f"postgres_{version}_ssl_{runtime}",
+                tag=f"postgres_{version}_ssl{suffix}",
             )
 
         #
@@ -154,10 +276,10 @@ for runtime in ["async-std", "tokio", "actix"]:
 
         for version in ["8", "5_7", "5_6"]:
             run(
-                f"cargo test --no-default-features --features macros,offline,any,all-types,mysql,runtime-{runtime}-{tls}",
+                commands["mysql"],
                 comment=f"test mysql {version}",
                 service=f"mysql_{version}",
-                tag=f"mysql_{version}" if runtime == "async-std" else f"mysql_{version}_{runtime}",
+                tag=f"mysql_{version}{suffix}",
             )
 
         #
@@ -166,10 +288,10 @@ for runtime in ["async-std", "tokio", "actix"]:
 
         for version in ["10_6", "10_5", "10_4", "10_3", "10_2"]:
             run(
-                f"cargo test --no-default-features --features macros,offline,any,all-types,mysql,runtime-{runtime}-{tls}",
+                commands["mysql"],
                 comment=f"test mariadb {version}",
                 service=f"mariadb_{version}",
-                tag=f"mariadb_{version}" if runtime == "async-std" else f"mariadb_{version}_{runtime}",
+                tag=f"mariadb_{version}{suffix}",
             )
 
         #
@@ -178,11 +300,106 @@ for runtime in ["async-std", "tokio", "actix"]:
 
         for version in ["2019", "2017"]:
             run(
-                f"cargo test --no-default-features --features macros,offline,any,all-types,mssql,runtime-{runtime}-{tls}",
+                commands["mssql"],
                 comment=f"test mssql {version}",
                 service=f"mssql_{version}",
-                tag=f"mssql_{version}" if runtime == "async-std" else f"mssql_{version}_{runtime}",
+                tag=f"mssql_{version}{suffix}",
             )
 
+#
+# execute
+#
+
+# a full matrix run gains nothing from incremental artifacts, it only writes more of them
+if tasks and not argv.incremental:
+    os.environ.setdefault("CARGO_INCREMENTAL", "0")
+
+# share compiled crates between cells (and runs) with sccache, when installed
+if tasks and "RUSTC_WRAPPER" not in os.environ and shutil.which("sccache"):
+    os.environ["RUSTC_WRAPPER"] = "sccache"
+
+if tasks and os.environ.get("RUSTC_WRAPPER"):
+    print(f"\x1b[2m # compiling with RUSTC_WRAPPER={os.environ['RUSTC_WRAPPER']}\x1b[0m")
+
+sccache = bool(tasks) and os.path.basename(os.environ.get("RUSTC_WRAPPER", "")).startswith("sccache")
+
+# start the server up front, rather than racing to start it from the first parallel rustc invocations
+if sccache:
+    subprocess.run([os.environ["RUSTC_WRAPPER"], "--start-server"], stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+# start every service used by the selected tasks at once, they are reused by every task
+services = {service for service, _ in tasks if service is not None}
+
+# in the background, tasks only wait for their own service (and sqlite for none)
+services_ready = start_services(services)
+
+if argv.stop:
+    atexit.register(stop_services, services)
+
+
+def execute_service_chain(service, chain):
+    if service in services_ready:
+        try:
+            services_ready[service].result()
+
+        except Exception as error:
+            with output_lock:
+                print(f"\x1b[91m ! {service} did not start: {error!r}\x1b[0m", file=sys.stderr, flush=True)
+
+            failed_tags.extend(task.keywords["tag"] for task in chain)
+            return 1
+
+    return execute_all(chain)
+
+
+# tests against the same service run one at a time, everything else runs independently
+chains = []
+service_chains = {}
+
+for service, task in tasks:
+    if service is None:
+        chains.append([task])
+
+    elif service in service_chains:
+        service_chains[service].append(task)
+
+    else:
+        service_chains[service] = [task]
+
+# with nothing running alongside, there is no output to interleave, so stream it as it comes
+streaming = min(argv.jobs, len(chains) + len(service_chains)) == 1
+
+executor = ThreadPoolExecutor(max_workers=argv.jobs)
+
+try:
+    # submitted first, so they are picked up while the services are still starting
+    futures = [executor.submit(execute_all, chain) for chain in chains]
+    futures += [executor.submit(execute_service_chain, service, chain) for service, chain in service_chains.items()]
+
+    returncodes = [future.result() for future in futures]
+
+except KeyboardInterrupt:
+    # running commands got the SIGINT as well; drop everything still queued
+    stopping.set()
+    cancel_waits()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    print("\x1b[91m interrupted\x1b[0m", file=sys.stderr, flush=True)
+    sys.exit(130)
+
+executor.shutdown()
+
+# show the cache hit rate, so regressions are visible
+if sccache:
+    subprocess.run([os.environ["RUSTC_WRAPPER"], "--show-stats"])
+
+if failed_tags:
+    print(f"\x1b[91m failed: {', '.join(failed_tags)}\x1b[0m", file=sys.stderr, flush=True)
+
+for returncode in returncodes:
+    if returncode != 0:
+        sys.exit(returncode)
+
 # TODO: Use [grcov] if available
 # ~/.cargo/bin/grcov tests/.cache/target/debug -s sqlx-core/ -t html --llvm --branch -o ./target/debug/coverage